@@ -1,15 +1,28 @@
 # This file is largely adapted from tracemalloc.
-from collections import Sequence, Iterable
 import fnmatch
-from functools import total_ordering
 import linecache
 import math
 import os.path
+import re
+
+try:
+    from collections.abc import Sequence, Iterable
+except ImportError:
+    # Python 2
+    from collections import Sequence, Iterable
+
+try:
+    from functools import lru_cache
+except ImportError:
+    # Python 2: no memoization.
+    def lru_cache(maxsize=128):
+        return lambda func: func
+
 
 # Import types and functions implemented in C
 try:
     from mprofile._profiler import *
-    from mprofile._profiler import _get_object_traceback, _get_traces
+    from mprofile._profiler import _get_object_traceback, _get_traces, _group_traces
 
     _ext_available = True
 except ImportError as e:
@@ -31,21 +44,24 @@ def _assert_ext_available():
         )
 
 
+_SIZE_UNITS = ("B", "KiB", "MiB", "GiB", "TiB")
+_SIZE_SCALES = (1, 1024, 1024 ** 2, 1024 ** 3, 1024 ** 4)
+
+
 def _format_size(size, sign):
-    for unit in ("B", "KiB", "MiB", "GiB", "TiB"):
-        if abs(size) < 100 and unit != "B":
-            # 3 digits (xx.x UNIT)
-            if sign:
-                return "%+.1f %s" % (size, unit)
-            else:
-                return "%.1f %s" % (size, unit)
-        if abs(size) < 10 * 1024 or unit == "TiB":
-            # 4 or 5 digits (xxxx UNIT)
-            if sign:
-                return "%+.0f %s" % (size, unit)
-            else:
-                return "%.0f %s" % (size, unit)
-        size /= 1024
+    abs_size = abs(size)
+    # Use the smallest unit in which the size is below 10 * 1024, i.e. the
+    # first k such that abs_size // 10 < 2 ** (10 * (k + 1)), up to TiB.
+    index = ((int(abs_size) // 10).bit_length() - 1) // 10
+    index = min(max(index, 0), len(_SIZE_UNITS) - 1)
+    size /= _SIZE_SCALES[index]
+    if index and abs(size) < 100:
+        # 3 digits (xx.x UNIT)
+        fmt = "%+.1f %s" if sign else "%.1f %s"
+    else:
+        # 4 or 5 digits (xxxx UNIT)
+        fmt = "%+.0f %s" if sign else "%.0f %s"
+    return fmt % (size, _SIZE_UNITS[index])
 
 
 class Statistic(object):
@@ -154,40 +170,57 @@ class StatisticDiff(object):
 
 
 def _compare_grouped_stats(old_group, new_group):
-    statistics = []
-    for traceback, stat in new_group.items():
-        previous = old_group.pop(traceback, None)
+    # Both groups map each Traceback to its (size, count) totals.
+    # Collect rows laid out as StatisticDiff._sort_key() followed by the
+    # signed diffs, so they can be sorted as plain tuples and the
+    # StatisticDiff instances built afterwards, already in order. Tracebacks
+    # are unique, so the signed diffs never take part in the comparison.
+    rows = []
+    old_get = old_group.get
+    for traceback, (size, count) in new_group.items():
+        previous = old_get(traceback)
         if previous is not None:
-            stat = StatisticDiff(
-                traceback,
-                stat.size,
-                stat.size - previous.size,
-                stat.count,
-                stat.count - previous.count,
-            )
+            size_diff = size - previous[0]
+            count_diff = count - previous[1]
         else:
-            stat = StatisticDiff(
-                traceback, stat.size, stat.size, stat.count, stat.count
+            size_diff = size
+            count_diff = count
+        rows.append(
+            (
+                abs(size_diff),
+                size,
+                abs(count_diff),
+                count,
+                traceback,
+                size_diff,
+                count_diff,
             )
-        statistics.append(stat)
+        )
 
-    for traceback, stat in old_group.items():
-        stat = StatisticDiff(traceback, 0, -stat.size, 0, -stat.count)
-        statistics.append(stat)
-    return statistics
+    # Tracebacks that are only in the old group.
+    for traceback, (size, count) in old_group.items():
+        if traceback not in new_group:
+            rows.append((size, 0, count, 0, traceback, -size, -count))
+
+    rows.sort(reverse=True)
+    return [
+        StatisticDiff(traceback, size, size_diff, count, count_diff)
+        for _, size, _, count, traceback, size_diff, count_diff in rows
+    ]
 
 
-@total_ordering
 class Frame(object):
     """
     Frame of a traceback.
     """
 
-    __slots__ = ("_frame",)
+    __slots__ = ("_frame", "_hash")
 
     def __init__(self, frame):
         # frame is a tuple: (name: str, filename: str, firstlineno: int, lineno: int)
         self._frame = frame
+        # Tuples do not cache their hash, so compute it once.
+        self._hash = hash(frame)
 
     @property
     def name(self):
@@ -208,11 +241,23 @@ class Frame(object):
     def __eq__(self, other):
         return self._frame == other._frame
 
+    def __ne__(self, other):
+        return self._frame != other._frame
+
     def __lt__(self, other):
         return self._frame < other._frame
 
+    def __le__(self, other):
+        return self._frame <= other._frame
+
+    def __gt__(self, other):
+        return self._frame > other._frame
+
+    def __ge__(self, other):
+        return self._frame >= other._frame
+
     def __hash__(self):
-        return hash(self._frame)
+        return self._hash
 
     def __str__(self):
         return "%s:%s" % (self.filename, self.lineno)
@@ -226,41 +271,91 @@ class Frame(object):
         )
 
 
-@total_ordering
+# Frame wrappers are immutable, so share them between accesses to the same
+# frame tuple rather than allocating a new one each time.
+_frame_flyweight = lru_cache(maxsize=8192)(Frame)
+
+
+def _first_difference(frames, other_frames):
+    # Walk two frames tuples from their oldest frame, without copying them in
+    # reverse, and return the first pair of frames that differ. If one is a
+    # suffix of the other, return their lengths instead, so that comparing
+    # the pair orders them as their reversed tuples would be.
+    for frame, other_frame in zip(reversed(frames), reversed(other_frames)):
+        if frame != other_frame:
+            return frame, other_frame
+    return len(frames), len(other_frames)
+
+
 class Traceback(Sequence):
     """
     Sequence of Frame instances sorted from the most recent frame
     to the oldest frame.
     """
 
-    __slots__ = ("_frames",)
+    __slots__ = ("_frames", "_hash")
 
     def __init__(self, frames):
-        Sequence.__init__(self)
         # frames is a tuple of frame tuples: see Frame constructor for the
-        # format of a frame tuple
-        self._frames = tuple(reversed(frames))
+        # format of a frame tuple. It is stored as given (most recent frame
+        # first), and indices are reversed on access.
+        self._frames = frames if isinstance(frames, tuple) else tuple(frames)
+        # Tracebacks are used as dict keys when grouping statistics, and
+        # tuples do not cache their hash, so compute it once.
+        self._hash = hash(self._frames)
 
     def __len__(self):
         return len(self._frames)
 
     def __getitem__(self, index):
         if isinstance(index, slice):
-            return tuple(Frame(trace) for trace in self._frames[index])
+            # Map the indices onto the stored tuple rather than copying it
+            # in reverse.
+            frames = self._frames
+            last = len(frames) - 1
+            return tuple(
+                _frame_flyweight(frames[last - i])
+                for i in range(*index.indices(len(frames)))
+            )
         else:
-            return Frame(self._frames[index])
+            return _frame_flyweight(self._frames[-1 - index])
+
+    # Iterate over the tuple directly rather than through the Sequence
+    # mixins, which call __getitem__ until it raises IndexError.
+    def __iter__(self):
+        return (_frame_flyweight(frame) for frame in reversed(self._frames))
+
+    def __reversed__(self):
+        return (_frame_flyweight(frame) for frame in self._frames)
 
     def __contains__(self, frame):
         return frame._frame in self._frames
 
     def __hash__(self):
-        return hash(self._frames)
+        return self._hash
 
     def __eq__(self, other):
         return self._frames == other._frames
 
+    def __ne__(self, other):
+        return self._frames != other._frames
+
+    # Tracebacks are ordered as their reversed (oldest frame first) sequences.
     def __lt__(self, other):
-        return self._frames < other._frames
+        frame, other_frame = _first_difference(self._frames, other._frames)
+        return frame < other_frame
+
+    def __le__(self, other):
+        frame, other_frame = _first_difference(self._frames, other._frames)
+        return frame <= other_frame
+
+    def __gt__(self, other):
+        frame, other_frame = _first_difference(self._frames, other._frames)
+        return frame > other_frame
+
+    def __ge__(self, other):
+        frame, other_frame = _first_difference(self._frames, other._frames)
+        return frame >= other_frame
 
     def __str__(self):
         return str(self[0])
@@ -295,11 +390,14 @@ def get_object_traceback(obj):
 
     Return None if the mprofile module is not tracing memory allocations or
     did not trace the allocation of the object.
+
+    Frame filenames are normalized as in take_snapshot(), so that the
+    traceback compares equal to the one of the same trace in a snapshot.
     """
     _assert_ext_available()
     frames = _get_object_traceback(obj)
     if frames:
-        return Traceback(frames)
+        return Traceback(_normalize_frames(frames))
     else:
         return None
 
@@ -342,7 +440,6 @@ class Trace(object):
 
 class _Traces(Sequence):
     def __init__(self, traces):
-        Sequence.__init__(self)
         # traces is a tuple of trace tuples: see Trace constructor
         self._traces = traces
 
@@ -355,6 +452,9 @@ class _Traces(Sequence):
         else:
             return Trace(self._traces[index])
 
+    def __iter__(self):
+        return (Trace(trace) for trace in self._traces)
+
     def __contains__(self, trace):
         return trace._trace in self._traces
 
@@ -365,6 +465,7 @@ class _Traces(Sequence):
         return "<Traces len=%s>" % len(self)
 
 
+@lru_cache(maxsize=2048)
 def _normalize_filename(filename):
     filename = os.path.normcase(filename)
     if filename.endswith((".pyc", ".pyo")):
@@ -374,8 +475,14 @@ def _normalize_filename(filename):
 
 class Filter(object):
     def __init__(self, inclusive, filename_pattern, lineno=None, all_frames=False):
-        self.inclusive = inclusive
+        # Matches are compared against inclusive, so it must be a bool, while
+        # filter_traces() only tests its truth value.
+        self.inclusive = bool(inclusive)
         self._filename_pattern = _normalize_filename(filename_pattern)
+        # Translate the glob once rather than on every fnmatch() call.
+        self._filename_re_match = re.compile(
+            fnmatch.translate(self._filename_pattern)
+        ).match
         self.lineno = lineno
         self.all_frames = all_frames
 
@@ -383,9 +490,11 @@ class Filter(object):
     def filename_pattern(self):
         return self._filename_pattern
 
-    def __match_frame(self, filename, lineno):
-        filename = _normalize_filename(filename)
-        if not fnmatch.fnmatch(filename, self._filename_pattern):
+    def _match_frame_raw(self, filename, lineno):
+        return self._match_normalized_frame(_normalize_filename(filename), lineno)
+
+    def _match_normalized_frame(self, filename, lineno):
+        if not self._filename_re_match(filename):
             return False
         if self.lineno is None:
             return True
@@ -393,20 +502,137 @@ class Filter(object):
             return lineno == self.lineno
 
     def _match_frame(self, filename, lineno):
-        return self.__match_frame(filename, lineno) ^ (not self.inclusive)
+        return self._match_frame_raw(filename, lineno) == self.inclusive
 
-    def _match_traceback(self, traceback):
+    def _match_traceback(self, traceback, normalized=False):
+        # If normalized, the frame filenames have already been normalized
+        # (see _normalize_traces) and are matched as is.
+        if normalized:
+            match_frame = self._match_normalized_frame
+        else:
+            match_frame = self._match_frame_raw
         if self.all_frames:
-            if any(
-                self.__match_frame(filename, lineno)
-                for _, filename, _, lineno in traceback
-            ):
-                return self.inclusive
-            else:
-                return not self.inclusive
+            matched = any(
+                match_frame(filename, lineno) for _, filename, _, lineno in traceback
+            )
         else:
             _, filename, _, lineno = traceback[0]
-            return self._match_frame(filename, lineno)
+            matched = match_frame(filename, lineno)
+        return matched == self.inclusive
+
+    def _traceback_matcher(self, filenames, normalized=False):
+        # Return a function equivalent to _match_traceback() for tracebacks
+        # whose filenames are all in filenames. Without a lineno, whether a
+        # frame matches only depends on its filename, so it is decided once
+        # per filename up front and looked up for each frame.
+        if self.lineno is not None:
+            return lambda traceback: self._match_traceback(traceback, normalized)
+
+        if normalized:
+            match_frame = self._match_normalized_frame
+        else:
+            match_frame = self._match_frame_raw
+        inclusive = self.inclusive
+        if self.all_frames:
+            matches = {filename: match_frame(filename, None) for filename in filenames}
+
+            def match(traceback):
+                matched = any(matches[filename] for _, filename, _, _ in traceback)
+                return matched == inclusive
+
+        else:
+            matches = {
+                filename: match_frame(filename, None) == inclusive
+                for filename in filenames
+            }
+
+            def match(traceback):
+                return matches[traceback[0][1]]
+
+        return match
+
+
+def _traceback_checker(include_matchers, exclude_matchers):
+    # Specialize the check on which kinds of filters are present, so that the
+    # per-trace loop does not re-test them.
+    if not exclude_matchers:
+
+        def check(traceback):
+            return any(match(traceback) for match in include_matchers)
+
+    elif not include_matchers:
+
+        def check(traceback):
+            return all(match(traceback) for match in exclude_matchers)
+
+    else:
+
+        def check(traceback):
+            return any(match(traceback) for match in include_matchers) and all(
+                match(traceback) for match in exclude_matchers
+            )
+
+    return check
+
+
+def _trace_filenames(traces):
+    # Tracebacks are deduped by _get_traces(), so only visit each one once.
+    tracebacks = {id(traceback): traceback for _, traceback in traces}
+    return {
+        filename for traceback in tracebacks.values() for _, filename, _, _ in traceback
+    }
+
+
+def _normalize_frames(frames):
+    # Return frames with normalized filenames, or frames itself if they are
+    # already normalized.
+    normalized = tuple(
+        (name, _normalize_filename(filename), firstlineno, lineno)
+        for name, filename, firstlineno, lineno in frames
+    )
+    if normalized == frames:
+        return frames
+    return normalized
+
+
+def _normalize_traces(traces):
+    # Normalize the filename of every frame once up front, so that filters
+    # can match snapshot traces without normalizing each frame they probe.
+    # _get_traces() dedupes identical tracebacks, so each one is only
+    # rewritten once, and tracebacks that are already normalized are kept.
+    normalized_tracebacks = {}
+    normalized_traces = []
+    for trace in traces:
+        size, traceback = trace
+        normalized = normalized_tracebacks.get(id(traceback))
+        if normalized is None:
+            normalized = _normalize_frames(traceback)
+            normalized_tracebacks[id(traceback)] = normalized
+        if normalized is not traceback:
+            trace = (size, normalized)
+        normalized_traces.append(trace)
+    return tuple(normalized_traces)
+
+
+def _traceback_group_frames(frames):
+    return frames
+
+
+def _lineno_group_frames(frames):
+    return frames[:1]
+
+
+def _filename_group_frames(frames):
+    # Synthetic frame with just the filename.
+    return (("", frames[0][1], 0, 0),)
+
+
+# The frames of the group that a traceback belongs to, by key_type.
+_group_frames = {
+    "traceback": _traceback_group_frames,
+    "lineno": _lineno_group_frames,
+    "filename": _filename_group_frames,
+}
 
 
 class Snapshot(object):
@@ -414,28 +640,14 @@ class Snapshot(object):
     Snapshot of traces of memory blocks allocated by Python.
     """
 
-    def __init__(self, traces, traceback_limit, sample_rate=0):
+    def __init__(self, traces, traceback_limit, sample_rate=0, _normalized=False):
         # traces is a tuple of trace tuples: see _Traces constructor for
         # the exact format
         self.traces = _Traces(traces)
         self.traceback_limit = traceback_limit
         self.sample_rate = sample_rate
-
-    def _filter_trace(self, include_filters, exclude_filters, trace):
-        traceback = trace[1]
-        if include_filters:
-            if not any(
-                trace_filter._match_traceback(traceback)
-                for trace_filter in include_filters
-            ):
-                return False
-        if exclude_filters:
-            if any(
-                not trace_filter._match_traceback(traceback)
-                for trace_filter in exclude_filters
-            ):
-                return False
-        return True
+        # Whether frame filenames have been normalized by _normalize_traces.
+        self._normalized = _normalized
 
     def filter_traces(self, filters):
         """
@@ -448,21 +660,25 @@ class Snapshot(object):
                 "filters must be a list of filters, not %s" % type(filters).__name__
             )
         if filters:
-            include_filters = []
-            exclude_filters = []
+            filenames = _trace_filenames(self.traces._traces)
+            include_matchers = []
+            exclude_matchers = []
             for trace_filter in filters:
+                match = trace_filter._traceback_matcher(filenames, self._normalized)
                 if trace_filter.inclusive:
-                    include_filters.append(trace_filter)
+                    include_matchers.append(match)
                 else:
-                    exclude_filters.append(trace_filter)
-            new_traces = [
-                trace
-                for trace in self.traces._traces
-                if self._filter_trace(include_filters, exclude_filters, trace)
-            ]
+                    exclude_matchers.append(match)
+            check = _traceback_checker(include_matchers, exclude_matchers)
+            new_traces = [trace for trace in self.traces._traces if check(trace[1])]
         else:
             new_traces = self.traces._traces[:]
-        return Snapshot(new_traces, self.traceback_limit, self.sample_rate)
+        return Snapshot(
+            new_traces,
+            self.traceback_limit,
+            self.sample_rate,
+            _normalized=self._normalized,
+        )
 
     def _group_by(self, key_type, cumulative):
         if key_type not in ("traceback", "filename", "lineno"):
@@ -472,66 +688,72 @@ class Snapshot(object):
                 "cumulative mode cannot by used " "with key type %r" % key_type
             )
 
-        stats = {}
-        tracebacks = {}
+        if _ext_available:
+            # Aggregate in the C extension, and only wrap the (much smaller)
+            # set of groups in Traceback and Statistic objects.
+            grouped = _group_traces(self.traces._traces, key_type, cumulative)
+            totals = {Traceback(frames): total for frames, total in grouped.items()}
+            return self._scale_heap_samples(totals)
+
+        # totals maps each Traceback to a mutable [size, count] pair.
+        totals = {}
+        totals_get = totals.get
+        group_frames = _group_frames[key_type]
         if not cumulative:
-            for trace in self.traces._traces:
-                size, trace_traceback = trace
-                try:
-                    traceback = tracebacks[trace_traceback]
-                except KeyError:
-                    if key_type == "traceback":
-                        frames = trace_traceback
-                    elif key_type == "lineno":
-                        frames = trace_traceback[:1]
-                    else:  # key_type == 'filename':
-                        # Synthetic frame with just the filename.
-                        frames = (("", trace_traceback[0][1], 0, 0),)
-                    traceback = Traceback(frames)
+            tracebacks = {}
+            tracebacks_get = tracebacks.get
+            for size, trace_traceback in self.traces._traces:
+                traceback = tracebacks_get(trace_traceback)
+                if traceback is None:
+                    traceback = Traceback(group_frames(trace_traceback))
                     tracebacks[trace_traceback] = traceback
-                try:
-                    stat = stats[traceback]
-                    stat.size += size
-                    stat.count += 1
-                except KeyError:
-                    stats[traceback] = Statistic(traceback, size, 1)
+                total = totals_get(traceback)
+                if total is None:
+                    totals[traceback] = [size, 1]
+                else:
+                    total[0] += size
+                    total[1] += 1
         else:
-            # cumulative statistics
-            for trace in self.traces._traces:
-                size, trace_traceback = trace
+            # cumulative statistics: total by raw frame tuple, and only build
+            # the Traceback of each group once all frames have been counted.
+            frame_totals = {}
+            frame_totals_get = frame_totals.get
+            for size, trace_traceback in self.traces._traces:
                 for frame in trace_traceback:
-                    try:
-                        traceback = tracebacks[frame]
-                    except KeyError:
-                        if key_type == "lineno":
-                            frames = (frame,)
-                        else:  # key_type == 'filename':
-                            frames = (("", frame[1], 0, 0),)
-                        traceback = Traceback(frames)
-                        tracebacks[frame] = traceback
-                    try:
-                        stat = stats[traceback]
-                        stat.size += size
-                        stat.count += 1
-                    except KeyError:
-                        stats[traceback] = Statistic(traceback, size, 1)
-        return self._scale_heap_samples(stats)
-
-    def _scale_heap_samples(self, stats):
-        for tb, stat in stats.items():
-            stats[tb] = self._scale_heap_sample(stat)
-        return stats
-
-    def _scale_heap_sample(self, stat):
-        if stat.count == 0 or stat.size == 0:
-            return stat
+                    total = frame_totals_get(frame)
+                    if total is None:
+                        frame_totals[frame] = [size, 1]
+                    else:
+                        total[0] += size
+                        total[1] += 1
+            for frame, (size, count) in frame_totals.items():
+                traceback = Traceback(group_frames((frame,)))
+                total = totals_get(traceback)
+                if total is None:
+                    totals[traceback] = [size, count]
+                else:
+                    total[0] += size
+                    total[1] += count
+        return self._scale_heap_samples(totals)
+
+    def _scale_heap_samples(self, totals):
+        # Scale the sampled (size, count) totals of each traceback up to
+        # estimates of the true totals. Statistic objects are only built for
+        # the groups that are returned to the caller.
         if self.sample_rate <= 1:
-            return stat
-        avg_size = float(stat.size) / stat.count
-        scale = 1.0 / (1.0 - math.exp(-avg_size / self.sample_rate))
-        stat.size = int(scale * stat.size)
-        stat.count = int(scale * stat.count)
-        return stat
+            return totals
+
+        exp = math.exp
+        sample_rate = float(self.sample_rate)
+        scaled = {}
+        for traceback, (size, count) in totals.items():
+            if size and count:
+                avg_size = float(size) / count
+                scale = 1.0 / (1.0 - exp(-avg_size / sample_rate))
+                size = int(scale * size)
+                count = int(scale * count)
+            scaled[traceback] = (size, count)
+        return scaled
 
     def statistics(self, key_type, cumulative=False):
         """
@@ -539,9 +761,13 @@ class Snapshot(object):
         instances.
         """
         grouped = self._group_by(key_type, cumulative)
-        statistics = list(grouped.values())
-        statistics.sort(reverse=True, key=Statistic._sort_key)
-        return statistics
+        # Sort plain (size, count, traceback) rows, matching
+        # Statistic._sort_key(), before building the Statistic objects.
+        rows = [
+            (size, count, traceback) for traceback, (size, count) in grouped.items()
+        ]
+        rows.sort(reverse=True)
+        return [Statistic(traceback, size, count) for size, count, traceback in rows]
 
     def compare_to(self, old_snapshot, key_type, cumulative=False):
         """
@@ -551,14 +777,15 @@ class Snapshot(object):
         """
         new_group = self._group_by(key_type, cumulative)
         old_group = old_snapshot._group_by(key_type, cumulative)
-        statistics = _compare_grouped_stats(old_group, new_group)
-        statistics.sort(reverse=True, key=StatisticDiff._sort_key)
-        return statistics
+        return _compare_grouped_stats(old_group, new_group)
 
 
 def take_snapshot():
     """
     Take a snapshot of traces of memory blocks allocated by Python.
+
+    Frame filenames are normalized the same way as Filter patterns: with
+    os.path.normcase(), and with a ".pyc" or ".pyo" suffix replaced by ".py".
     """
     _assert_ext_available()
     if not is_tracing():
@@ -566,7 +793,7 @@ def take_snapshot():
             "the mprofile module must be tracing memory "
             "allocations to take a snapshot"
         )
-    traces = _get_traces()
+    traces = _normalize_traces(_get_traces())
     traceback_limit = get_traceback_limit()
     sample_rate = get_sample_rate()
-    return Snapshot(traces, traceback_limit, sample_rate)
+    return Snapshot(traces, traceback_limit, sample_rate, _normalized=True)
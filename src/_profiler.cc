@@ -2,9 +2,11 @@
 #include <Python.h>
 
 #include <cstdlib>
+#include <cstring>
 #include <memory>
 #include "third_party/google/tcmalloc/sampler.h"
 
+#include "group_by.h"
 #include "heap.h"
 #include "log.h"
 #include "malloc_patch.h"
@@ -136,6 +138,41 @@ PyObject *GetObjectTraceback(PyObject *self, PyObject *args) {
   return GetTrace(ptr);
 }
 
+PyObject *GroupBy(PyObject *self, PyObject *args) {
+  PyObject *traces;
+  const char *key_type;
+  PyObject *cumulative_obj;
+  if (!PyArg_ParseTuple(args, "OsO", &traces, &key_type, &cumulative_obj)) {
+    return nullptr;
+  }
+
+  GroupKey key;
+  if (strcmp(key_type, "traceback") == 0) {
+    key = GroupKey::kTraceback;
+  } else if (strcmp(key_type, "lineno") == 0) {
+    key = GroupKey::kLineno;
+  } else if (strcmp(key_type, "filename") == 0) {
+    key = GroupKey::kFilename;
+  } else {
+    PyErr_Format(PyExc_ValueError, "unknown key_type: '%s'", key_type);
+    return nullptr;
+  }
+
+  int cumulative = PyObject_IsTrue(cumulative_obj);
+  if (cumulative < 0) {
+    return nullptr;
+  }
+
+  if (cumulative && key == GroupKey::kTraceback) {
+    PyErr_Format(PyExc_ValueError,
+                 "cumulative mode cannot by used with key type '%s'",
+                 key_type);
+    return nullptr;
+  }
+
+  return GroupTraces(traces, key, cumulative);
+}
+
 int GetEnvFrames() {
   char *p = std::getenv("MPROFILEFRAMES");
   if (p == NULL || *p == '\0') {
@@ -232,6 +269,8 @@ PyMethodDef ProfilerMethods[] = {
      "Get the total memory traced by mprofile module (in bytes)."},
     {"_get_object_traceback", GetObjectTraceback, METH_VARARGS,
      "Get the traceback where a particular object was allocated."},
+    {"_group_traces", GroupBy, METH_VARARGS,
+     "Aggregate traces into (size, count) totals grouped by key_type."},
 
     // Private, used as an atexit handler to disable heap profiler.
     {"_atexit", (PyCFunction)MProfileAtexit, METH_NOARGS},
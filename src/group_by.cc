@@ -0,0 +1,190 @@
+// Copyright 2019 Timothy Palpant
+
+#include "group_by.h"
+
+#include <vector>
+
+#include "scoped_object.h"
+#include "third_party/greg7mdp/parallel-hashmap/phmap.h"
+
+namespace {
+
+#if PY_MAJOR_VERSION >= 3
+#define STRING_INTERN PyUnicode_InternFromString
+#else
+#define STRING_INTERN PyString_InternFromString
+typedef long Py_hash_t;
+#endif
+
+// A borrowed reference to the object identifying a group, along with its
+// hash. Keys are hashed once up front so that hashing errors can be
+// propagated, and so that tuple keys are not rehashed on every probe.
+struct HashedKey {
+  PyObject *obj;
+  Py_hash_t hash;
+};
+
+struct HashedKeyHash {
+  std::size_t operator()(const HashedKey &k) const { return k.hash; }
+};
+
+struct HashedKeyEqual {
+  bool operator()(const HashedKey &k1, const HashedKey &k2) const {
+    if (k1.obj == k2.obj) {
+      return true;
+    }
+    // NB: Errors are reported as "not equal", the caller must check
+    // PyErr_Occurred() after each lookup.
+    return k1.hash == k2.hash &&
+           PyObject_RichCompareBool(k1.obj, k2.obj, Py_EQ) == 1;
+  }
+};
+
+// Running totals for a single group.
+struct Group {
+  // Borrowed reference to the traceback, frame or filename of this group.
+  PyObject *key;
+  // Whether key is already a tuple of frames (rather than a single frame
+  // or filename that must be wrapped into one).
+  bool is_frames;
+  Py_ssize_t size;
+  Py_ssize_t count;
+};
+
+class TraceGrouper {
+ public:
+  // Add size to the group identified by key, creating it if necessary.
+  bool Add(PyObject *key, bool is_frames, Py_ssize_t size) {
+    Py_hash_t hash = PyObject_Hash(key);
+    if (hash == -1) {
+      return false;
+    }
+
+    auto it = index_.emplace(HashedKey{key, hash}, groups_.size());
+    if (PyErr_Occurred()) {
+      return false;
+    }
+
+    if (it.second) {  // New group.
+      groups_.push_back({key, is_frames, size, 1});
+    } else {
+      Group &group = groups_[it.first->second];
+      group.size += size;
+      group.count++;
+    }
+
+    return true;
+  }
+
+  // Build the dict of frames tuple -> (size, count) for all groups.
+  PyObjectRef Result(GroupKey key) const {
+    PyObjectRef result(PyDict_New());
+    if (result == nullptr) {
+      return nullptr;
+    }
+
+    PyObjectRef empty_name(STRING_INTERN(""));
+    if (empty_name == nullptr) {
+      return nullptr;
+    }
+
+    for (const Group &group : groups_) {
+      PyObjectRef frames;
+      if (group.is_frames) {
+        Py_INCREF(group.key);
+        frames.reset(group.key);
+      } else if (key == GroupKey::kLineno) {
+        frames.reset(Py_BuildValue("(O)", group.key));
+      } else {
+        // Synthetic frame with just the filename.
+        frames.reset(
+            Py_BuildValue("((OOii))", empty_name.get(), group.key, 0, 0));
+      }
+      if (frames == nullptr) {
+        return nullptr;
+      }
+
+      PyObjectRef value(Py_BuildValue("(nn)", group.size, group.count));
+      if (value == nullptr) {
+        return nullptr;
+      }
+
+      if (PyDict_SetItem(result.get(), frames.get(), value.get()) < 0) {
+        return nullptr;
+      }
+    }
+
+    return result;
+  }
+
+ private:
+  // Index of each group in groups_, which preserves insertion order.
+  phmap::flat_hash_map<HashedKey, std::size_t, HashedKeyHash, HashedKeyEqual>
+      index_;
+  std::vector<Group> groups_;
+};
+
+}  // namespace
+
+PyObject *GroupTraces(PyObject *traces, GroupKey key, bool cumulative) {
+  PyObjectRef seq(PySequence_Fast(traces, "traces must be a sequence"));
+  if (seq == nullptr) {
+    return nullptr;
+  }
+
+  TraceGrouper grouper;
+  Py_ssize_t num_traces = PySequence_Fast_GET_SIZE(seq.get());
+  PyObject **items = PySequence_Fast_ITEMS(seq.get());
+  for (Py_ssize_t i = 0; i < num_traces; i++) {
+    PyObject *trace = items[i];
+    if (!PyTuple_Check(trace) || PyTuple_GET_SIZE(trace) != 2 ||
+        !PyTuple_Check(PyTuple_GET_ITEM(trace, 1))) {
+      PyErr_SetString(PyExc_TypeError,
+                      "trace must be a (size, traceback) tuple");
+      return nullptr;
+    }
+
+    Py_ssize_t size =
+        PyNumber_AsSsize_t(PyTuple_GET_ITEM(trace, 0), PyExc_OverflowError);
+    if (size == -1 && PyErr_Occurred()) {
+      return nullptr;
+    }
+
+    PyObject *traceback = PyTuple_GET_ITEM(trace, 1);
+    Py_ssize_t num_frames = PyTuple_GET_SIZE(traceback);
+    if (key == GroupKey::kTraceback ||
+        (key == GroupKey::kLineno && !cumulative && num_frames == 0)) {
+      // traceback[:1] of an empty traceback is the traceback itself.
+      if (!grouper.Add(traceback, true, size)) {
+        return nullptr;
+      }
+      continue;
+    }
+
+    if (!cumulative) {
+      if (num_frames == 0) {
+        PyErr_SetString(PyExc_IndexError, "trace has an empty traceback");
+        return nullptr;
+      }
+      num_frames = 1;
+    }
+
+    for (Py_ssize_t j = 0; j < num_frames; j++) {
+      PyObject *frame = PyTuple_GET_ITEM(traceback, j);
+      if (!PyTuple_Check(frame) || PyTuple_GET_SIZE(frame) != 4) {
+        PyErr_SetString(
+            PyExc_TypeError,
+            "frame must be a (name, filename, firstlineno, lineno) tuple");
+        return nullptr;
+      }
+
+      PyObject *group_key =
+          key == GroupKey::kLineno ? frame : PyTuple_GET_ITEM(frame, 1);
+      if (!grouper.Add(group_key, false, size)) {
+        return nullptr;
+      }
+    }
+  }
+
+  return grouper.Result(key).release();
+}
@@ -0,0 +1,29 @@
+// Copyright 2019 Timothy Palpant
+
+#ifndef MPROFILE_SRC_GROUP_BY_H_
+#define MPROFILE_SRC_GROUP_BY_H_
+
+#include <Python.h>
+
+// The key used to group traces when computing statistics.
+enum class GroupKey {
+  // Group by the full traceback.
+  kTraceback,
+  // Group by (filename, lineno) of the most recent frame, or of every frame
+  // in the traceback if cumulative.
+  kLineno,
+  // Group by filename of the most recent frame, or of every frame in the
+  // traceback if cumulative.
+  kFilename,
+};
+
+// Aggregate the given sequence of (size, traceback) trace tuples, as returned
+// by _get_traces(), into a dict mapping the frames tuple of each group to a
+// (size, count) tuple. The frames tuples have the format expected by the
+// Traceback constructor.
+//
+// Returns a new reference, or nullptr with a Python exception set on error.
+// The GIL must be held.
+PyObject *GroupTraces(PyObject *traces, GroupKey key, bool cumulative);
+
+#endif  // MPROFILE_SRC_GROUP_BY_H_
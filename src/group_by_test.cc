@@ -0,0 +1,86 @@
+// Copyright 2019 Timothy Palpant
+#include "group_by.h"
+
+#include "gtest/gtest.h"
+#include "scoped_object.h"
+
+namespace {
+
+// Build a list of (size, traceback) tuples like _get_traces() returns.
+PyObjectRef NewTestTraces() {
+  return PyObjectRef(
+      Py_BuildValue("[(i((siii)(siii)))(i((siii)(siii)))(i((siii)))]",
+                    // a.py:2 <- b.py:4
+                    10, "f", "a.py", 1, 2, "g", "b.py", 1, 4,
+                    // a.py:5 <- b.py:4
+                    2, "f", "a.py", 1, 5, "g", "b.py", 1, 4,
+                    // b.py:1
+                    66, "g", "b.py", 1, 1));
+}
+
+// Look up the (size, count) of the group with the given frames tuple.
+std::pair<long, long> GetGroup(PyObject *grouped, PyObject *frames) {
+  PyObject *value = PyDict_GetItem(grouped, frames);
+  if (value == nullptr) {
+    return {-1, -1};
+  }
+  long size, count;
+  if (!PyArg_ParseTuple(value, "ll", &size, &count)) {
+    PyErr_Clear();
+    return {-1, -1};
+  }
+  return {size, count};
+}
+
+}  // namespace
+
+TEST(GroupTraces, Traceback) {
+  PyObjectRef traces(NewTestTraces());
+  ASSERT_NE(traces, nullptr);
+  PyObjectRef grouped(GroupTraces(traces.get(), GroupKey::kTraceback, false));
+  ASSERT_NE(grouped, nullptr);
+  EXPECT_EQ(PyDict_Size(grouped.get()), 3);
+
+  PyObjectRef tb(Py_BuildValue("((siii))", "g", "b.py", 1, 1));
+  EXPECT_EQ(GetGroup(grouped.get(), tb.get()), std::make_pair(66L, 1L));
+}
+
+TEST(GroupTraces, Lineno) {
+  PyObjectRef traces(NewTestTraces());
+  ASSERT_NE(traces, nullptr);
+  PyObjectRef grouped(GroupTraces(traces.get(), GroupKey::kLineno, false));
+  ASSERT_NE(grouped, nullptr);
+  EXPECT_EQ(PyDict_Size(grouped.get()), 3);
+
+  PyObjectRef cumulative(GroupTraces(traces.get(), GroupKey::kLineno, true));
+  ASSERT_NE(cumulative, nullptr);
+  EXPECT_EQ(PyDict_Size(cumulative.get()), 4);
+
+  PyObjectRef tb(Py_BuildValue("((siii))", "g", "b.py", 1, 4));
+  EXPECT_EQ(GetGroup(cumulative.get(), tb.get()), std::make_pair(12L, 2L));
+}
+
+TEST(GroupTraces, Filename) {
+  PyObjectRef traces(NewTestTraces());
+  ASSERT_NE(traces, nullptr);
+  PyObjectRef grouped(GroupTraces(traces.get(), GroupKey::kFilename, false));
+  ASSERT_NE(grouped, nullptr);
+  EXPECT_EQ(PyDict_Size(grouped.get()), 2);
+
+  PyObjectRef tb_a(Py_BuildValue("((siii))", "", "a.py", 0, 0));
+  EXPECT_EQ(GetGroup(grouped.get(), tb_a.get()), std::make_pair(12L, 2L));
+
+  PyObjectRef cumulative(GroupTraces(traces.get(), GroupKey::kFilename, true));
+  ASSERT_NE(cumulative, nullptr);
+  PyObjectRef tb_b(Py_BuildValue("((siii))", "", "b.py", 0, 0));
+  EXPECT_EQ(GetGroup(cumulative.get(), tb_b.get()), std::make_pair(78L, 3L));
+}
+
+TEST(GroupTraces, InvalidTrace) {
+  PyObjectRef traces(Py_BuildValue("[(i)]", 10));
+  ASSERT_NE(traces, nullptr);
+  PyObjectRef grouped(GroupTraces(traces.get(), GroupKey::kTraceback, false));
+  EXPECT_EQ(grouped, nullptr);
+  EXPECT_TRUE(PyErr_ExceptionMatches(PyExc_TypeError));
+  PyErr_Clear();
+}
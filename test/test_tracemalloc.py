@@ -200,9 +200,6 @@ class TestMProfileEnabled(unittest.TestCase):
 
         traces = mprofile._get_traces()
 
-        obj1_traceback._frames = tuple(reversed(obj1_traceback._frames))
-        obj2_traceback._frames = tuple(reversed(obj2_traceback._frames))
-
         trace1 = self.find_trace(traces, obj1_traceback)
         trace2 = self.find_trace(traces, obj2_traceback)
         size1, traceback1 = trace1
@@ -336,6 +333,47 @@ class TestSnapshot(unittest.TestCase):
             self.assertEqual(trace.traceback[0].filename, "a.py")
             self.assertEqual(trace.traceback[0].lineno, 2)
 
+    def test_create_snapshot_normalize_filename(self):
+        raw_traces = [
+            (5, (("test", "a.pyc", 1, 2), ("test", "b.py", 1, 4))),
+            (7, (("test", "b.py", 1, 1),)),
+        ]
+
+        with contextlib.ExitStack() as stack:
+            stack.enter_context(patch.object(mprofile, "is_tracing", return_value=True))
+            stack.enter_context(
+                patch.object(mprofile, "get_traceback_limit", return_value=5)
+            )
+            stack.enter_context(
+                patch.object(mprofile, "get_sample_rate", return_value=1)
+            )
+            stack.enter_context(
+                patch.object(mprofile, "_get_traces", return_value=raw_traces)
+            )
+
+            snapshot = mprofile.take_snapshot()
+            self.assertEqual(
+                snapshot.traces._traces,
+                (
+                    (5, (("test", "a.py", 1, 2), ("test", "b.py", 1, 4))),
+                    (7, (("test", "b.py", 1, 1),)),
+                ),
+            )
+            # Already normalized traces are not copied.
+            self.assertIs(snapshot.traces._traces[1], raw_traces[1])
+
+            snapshot2 = snapshot.filter_traces((mprofile.Filter(True, "a.py"),))
+            self.assertEqual(len(snapshot2.traces), 1)
+
+    def test_get_object_traceback_normalize_filename(self):
+        raw_frames = (("test", "a.pyc", 1, 2), ("test", "b.py", 1, 4))
+        with patch.object(mprofile, "_get_object_traceback", return_value=raw_frames):
+            traceback = mprofile.get_object_traceback(object())
+        self.assertEqual(
+            traceback,
+            mprofile.Traceback((("test", "a.py", 1, 2), ("test", "b.py", 1, 4))),
+        )
+
     def test_filter_traces(self):
         snapshot, snapshot2 = create_snapshots()
         filter1 = mprofile.Filter(False, "b.py")
@@ -380,6 +418,71 @@ class TestSnapshot(unittest.TestCase):
 
         self.assertRaises(TypeError, snapshot.filter_traces, filter1)
 
+    def test_filter_traces_all_frames(self):
+        snapshot, snapshot2 = create_snapshots()
+        b_traces = [
+            (10, (("test", "a.py", 1, 2), ("test", "b.py", 1, 4))),
+            (10, (("test", "a.py", 1, 2), ("test", "b.py", 1, 4))),
+            (10, (("test", "a.py", 1, 2), ("test", "b.py", 1, 4))),
+            (2, (("test", "a.py", 1, 5), ("test", "b.py", 1, 4))),
+            (66, (("test", "b.py", 1, 1),)),
+        ]
+        unknown_trace = (7, (("test", "<unknown>", 1, 0),))
+
+        # include any frame of b.py
+        snapshot3 = snapshot.filter_traces((mprofile.Filter(True, "b.py", None, True),))
+        self.assertEqual(snapshot3.traces._traces, b_traces)
+
+        # exclude any frame of b.py
+        snapshot4 = snapshot.filter_traces(
+            (mprofile.Filter(False, "b.py", None, True),)
+        )
+        self.assertEqual(snapshot4.traces._traces, [unknown_trace])
+
+        # exclude any frame of b.py line 4
+        snapshot5 = snapshot.filter_traces((mprofile.Filter(False, "b.py", 4, True),))
+        self.assertEqual(snapshot5.traces._traces, [b_traces[4], unknown_trace])
+
+        # include a.py as most recent frame, but exclude any frame of b.py line 1
+        snapshot6 = snapshot.filter_traces(
+            (
+                mprofile.Filter(True, "a.py"),
+                mprofile.Filter(True, "b.py", 1, True),
+                mprofile.Filter(False, "b.py", 1, True),
+            )
+        )
+        self.assertEqual(snapshot6.traces._traces, b_traces[:4])
+
+    def test_filter_traces_normalized(self):
+        raw_traces = [
+            (5, (("test", "a.pyc", 1, 2), ("test", "b.py", 1, 4))),
+            (7, (("test", "b.pyo", 1, 1),)),
+            (9, (("test", "c.py", 1, 3), ("test", "a.pyc", 1, 8))),
+        ]
+        snapshot = mprofile.Snapshot(raw_traces, 2)
+        normalized_snapshot = mprofile.Snapshot(
+            mprofile._normalize_traces(raw_traces), 2, _normalized=True
+        )
+
+        filter_lists = [
+            (mprofile.Filter(True, "a.py"),),
+            (mprofile.Filter(True, "a.pyc", None, True),),
+            (mprofile.Filter(False, "b.py"),),
+            (mprofile.Filter(False, "a.py", None, True),),
+            (mprofile.Filter(True, "*.py", 8, True), mprofile.Filter(False, "b.py")),
+        ]
+        for filters in filter_lists:
+            with self.subTest(filters=filters):
+                sizes = [trace.size for trace in snapshot.filter_traces(filters).traces]
+                normalized_filtered = normalized_snapshot.filter_traces(filters)
+                self.assertTrue(normalized_filtered._normalized)
+                self.assertEqual(
+                    [trace.size for trace in normalized_filtered.traces], sizes
+                )
+
+        filtered = normalized_snapshot.filter_traces(filter_lists[0])
+        self.assertEqual([trace.size for trace in filtered.traces], [5])
+
     def test_snapshot_group_by_line(self):
         snapshot, snapshot2 = create_snapshots()
         tb_0 = traceback_lineno("<unknown>", 0)
@@ -572,6 +675,60 @@ class TestSnapshot(unittest.TestCase):
         traceback = snapshot.traces[0].traceback
         self.assertEqual(traceback[:2], (traceback[0], traceback[1]))
 
+    def check_ordered(self, lesser, greater):
+        self.assertTrue(lesser < greater)
+        self.assertTrue(lesser <= greater)
+        self.assertFalse(lesser > greater)
+        self.assertFalse(lesser >= greater)
+        self.assertFalse(lesser == greater)
+        self.assertTrue(lesser != greater)
+
+        self.assertFalse(greater < lesser)
+        self.assertFalse(greater <= lesser)
+        self.assertTrue(greater > lesser)
+        self.assertTrue(greater >= lesser)
+        self.assertFalse(greater == lesser)
+        self.assertTrue(greater != lesser)
+
+    def check_equal(self, first, second):
+        self.assertFalse(first < second)
+        self.assertTrue(first <= second)
+        self.assertFalse(first > second)
+        self.assertTrue(first >= second)
+        self.assertTrue(first == second)
+        self.assertFalse(first != second)
+        self.assertEqual(hash(first), hash(second))
+
+    def test_frame_comparisons(self):
+        self.check_equal(frame("f", "a.py", 1, 2), frame("f", "a.py", 1, 2))
+        self.check_ordered(frame("f", "a.py", 1, 2), frame("f", "a.py", 1, 3))
+        self.check_ordered(frame("f", "b.py", 1, 2), frame("g", "a.py", 1, 2))
+        self.check_ordered(frame("f", "a.py", 1, 2), frame("g", "a.py", 1, 2))
+
+    def test_traceback_comparisons(self):
+        # Tracebacks are ordered from the oldest frame to the most recent one.
+        self.check_equal(
+            traceback(("a.py", 1), ("b.py", 2)), traceback(("a.py", 1), ("b.py", 2))
+        )
+        self.check_equal(traceback(), traceback())
+        self.check_ordered(traceback(), traceback(("a.py", 1)))
+        self.check_ordered(traceback(("a.py", 2)), traceback(("b.py", 1)))
+        # The oldest frame decides, even if the most recent one differs the
+        # other way around.
+        self.check_ordered(
+            traceback(("b.py", 1), ("a.py", 1)), traceback(("a.py", 1), ("b.py", 1))
+        )
+        self.check_ordered(
+            traceback(("c.py", 9), ("a.py", 1)), traceback(("a.py", 2), ("a.py", 3))
+        )
+        # A traceback which extends another one with more recent frames is
+        # greater.
+        self.check_ordered(traceback(("a.py", 1)), traceback(("b.py", 2), ("a.py", 1)))
+        self.check_ordered(
+            traceback(("a.py", 1), ("b.py", 2)),
+            traceback(("a.py", 1), ("a.py", 1), ("b.py", 2)),
+        )
+
     def test_format_traceback(self):
         snapshot, snapshot2 = create_snapshots()
 
@@ -619,6 +776,22 @@ class TestSnapshot(unittest.TestCase):
             )
 
 
+class TestSnapshotPythonGroupBy(unittest.TestCase):
+    """Run the group_by tests against the pure Python fallback of _group_traces."""
+
+    maxDiff = 4000
+
+    def setUp(self):
+        patcher = patch.object(mprofile, "_ext_available", False)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    test_snapshot_group_by_line = TestSnapshot.test_snapshot_group_by_line
+    test_snapshot_group_by_file = TestSnapshot.test_snapshot_group_by_file
+    test_snapshot_group_by_traceback = TestSnapshot.test_snapshot_group_by_traceback
+    test_snapshot_group_by_cumulative = TestSnapshot.test_snapshot_group_by_cumulative
+
+
 class TestFilters(unittest.TestCase):
     maxDiff = 2048
 
@@ -701,6 +874,33 @@ class TestFilters(unittest.TestCase):
         self.assertTrue(f._match_frame("12356", 5))
         self.assertTrue(f._match_frame("12356", 10))
 
+    def test_filter_inclusive_truth_value(self):
+        # inclusive is only used for its truth value
+        snapshot, snapshot2 = create_snapshots()
+        for inclusive in (2, "x"):
+            f = mprofile.Filter(inclusive, "b.py")
+            self.assertIs(f.inclusive, True)
+            self.assertTrue(f._match_frame("b.py", 1))
+            self.assertFalse(f._match_frame("a.py", 1))
+            self.assertEqual(
+                snapshot.filter_traces([f]).traces._traces,
+                [(66, (("test", "b.py", 1, 1),))],
+            )
+
+        for inclusive in (None, 0, ""):
+            f = mprofile.Filter(inclusive, "b.py")
+            self.assertIs(f.inclusive, False)
+            self.assertFalse(f._match_frame("b.py", 1))
+            self.assertTrue(f._match_frame("a.py", 1))
+            self.assertEqual(
+                snapshot.filter_traces([f]).traces._traces,
+                [
+                    trace
+                    for trace in snapshot.traces._traces
+                    if trace[1][0][1] != "b.py"
+                ],
+            )
+
     def test_filter_match_filename(self):
         def fnmatch(inclusive, filename, pattern):
             f = mprofile.Filter(inclusive, pattern)